@@ -8,11 +8,11 @@
 import os
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 
 import numpy as np
 import torch
-import cv2 as cv
 
 
 import utils.utils as utils
@@ -21,41 +21,40 @@ import utils.video_utils as video_utils
 
 
 # layer.backward(layer) <- original implementation did it like this it's equivalent to MSE(reduction='sum')/2
-def gradient_ascent(config, model, input_tensor, layer_ids_to_use, iteration):
-    out = model(input_tensor)
-    # step1: Grab activations/feature maps of interest
-    activations = [out[layer_id_to_use] for layer_id_to_use in layer_ids_to_use]
-
-    # step2: Calculate loss over activations
-    losses = []
-    for layer_activation in activations:
-        # torch.norm(torch.flatten(layer_activation), p=2) for p=2 => L2 loss; for p=1 => L1 loss. MSE works really good
-        loss_component = torch.nn.MSELoss(reduction='mean')(layer_activation, torch.zeros_like(layer_activation))
-        losses.append(loss_component)
-
-    loss = torch.mean(torch.stack(losses))
-    loss.backward()
+def gradient_ascent(config, model, input_tensor, layer_ids_to_use, gaussian_smoothing):
+    with utils.bf16_autocast(input_tensor.device, enabled=config['use_bf16']):
+        out = model(input_tensor)
+    # step1: Grab activations/feature maps of interest (.float() keeps the gradient seeds in float32 under autocast)
+    activations = [out[layer_id_to_use].float() for layer_id_to_use in layer_ids_to_use]
+
+    # step2: Backpropagate the loss over activations
+    # The loss is the mean over layers of MSE(layer_activation, 0) with reduction='mean'. Instead of building it and
+    # calling backward() we seed the backward pass directly with its gradient dL/da = 2 * a / (num_layers * a.numel())
+    # (the same trick as layer.backward(layer) above only with mean instead of sum reduction)
+    grad_seeds = [layer_activation.detach() * (2 / (len(activations) * layer_activation.numel())) for layer_activation in activations]
+    torch.autograd.backward(activations, grad_seeds)
 
     # step3: Process image gradients (smoothing + normalization)
     grad = input_tensor.grad.data
 
-    sigma = ((iteration + 1) / config['num_gradient_ascent_iterations']) * 2.0 + config['smoothing_coefficient']
-    smooth_grad = utils.CascadeGaussianSmoothing(KERNEL_SIZE, sigma)(grad)  # applies 3 Gaussian kernels
+    smooth_grad = gaussian_smoothing(grad)  # applies 3 Gaussian kernels
 
     g_norm = torch.std(smooth_grad)  # g_norm = torch.mean(torch.abs(smooth_grad)) <- other option std works better
 
     # step4: Update image using the calculated gradients (gradient ascent step)
-    input_tensor.data += config['lr'] * (smooth_grad / g_norm)
+    img = input_tensor.data
+    img.addcdiv_(smooth_grad, g_norm, value=config['lr'])  # img += lr * (smooth_grad / g_norm) in a single pass
 
-    # step5: Clear gradients and clamp the data (otherwise values would explode to +- "infinity")
-    input_tensor.grad.data.zero_()
-    input_tensor.data = torch.max(torch.min(input_tensor, UPPER_IMAGE_BOUND), LOWER_IMAGE_BOUND)
+    # step5: Clear gradients and clamp the data in-place (otherwise values would explode to +- "infinity")
+    input_tensor.grad = None  # cheaper than zeroing it (no memset), the next backward() will allocate a fresh one
+    lower_bound, upper_bound = utils.get_image_bounds(img.device, img.dtype)
+    torch.max(torch.min(img, upper_bound, out=img), lower_bound, out=img)
 
 
 def deep_dream_static_image(config, img):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU
 
-    model = utils.fetch_and_prepare_model(config['model'], config['pretrained_weights'], device)
+    model = utils.fetch_and_prepare_model(config['model'], config['pretrained_weights'], device, config['use_compile'])
     try:
         layer_ids_to_use = [model.layer_names.index(layer_name) for layer_name in config['layers_to_use']]
     except Exception as e:  # making sure you set the correct layer name for this specific model
@@ -65,45 +64,59 @@ def deep_dream_static_image(config, img):
 
     if img is None:  # load either image or start from pure noise image
         img_path = os.path.join(config['inputs_path'], config['input'])
-        img = utils.load_image(img_path, target_shape=config['img_width'])  # load numpy, [0, 1], channel-last, RGB image
+        img = utils.load_image(img_path, target_shape=config['img_width'], keep_uint8=True)  # numpy, uint8, channel-last, RGB
         if config['use_noise']:
             shape = img.shape
             img = np.random.uniform(low=0.0, high=1.0, size=shape).astype(np.float32)
 
-    img = utils.preprocess_numpy_img(img)
+    # Smoothing sigma depends only on the iteration so the Gaussian kernels are built once (and reused across frames)
+    gaussian_smoothings = []
+    for iteration in range(config['num_gradient_ascent_iterations']):
+        sigma = ((iteration + 1) / config['num_gradient_ascent_iterations']) * 2.0 + config['smoothing_coefficient']
+        gaussian_smoothings.append(utils.get_cascade_gaussian_smoothing(KERNEL_SIZE, sigma, device))
+
     base_shape = img.shape[:-1]  # save initial height and width
+    pyramid_shapes = [utils.get_new_shape(config, base_shape, pyramid_level) for pyramid_level in range(config['pyramid_size'])]
+    input_tensor = utils.pytorch_input_adapter(img, device)  # normalizes the image, from here on it stays on the device
 
     # Note: simply rescaling the whole result (and not only details, see original implementation) gave me better results
     # Going from smaller to bigger resolution (from pyramid top to bottom)
-    for pyramid_level in range(config['pyramid_size']):
-        new_shape = utils.get_new_shape(config, base_shape, pyramid_level)
-        img = cv.resize(img, (new_shape[1], new_shape[0]))
-        input_tensor = utils.pytorch_input_adapter(img, device)
+    # Note: levels can't be batched into a single forward pass as each level starts from the previous level's result
+    for new_shape in pyramid_shapes:
+        input_tensor = utils.resize_tensor(input_tensor, new_shape)
 
+        # Undoing the last shift and applying the next one is merged into a single roll, we only undo once per level
+        h_offset, w_offset = 0, 0
         for iteration in range(config['num_gradient_ascent_iterations']):
             h_shift, w_shift = np.random.randint(-config['spatial_shift_size'], config['spatial_shift_size'] + 1, 2)
-            input_tensor = utils.random_circular_spatial_shift(input_tensor, h_shift, w_shift)
+            input_tensor = utils.random_circular_spatial_shift(input_tensor, h_shift - h_offset, w_shift - w_offset)
+            h_offset, w_offset = h_shift, w_shift
 
-            gradient_ascent(config, model, input_tensor, layer_ids_to_use, iteration)
+            gradient_ascent(config, model, input_tensor, layer_ids_to_use, gaussian_smoothings[iteration])
 
-            input_tensor = utils.random_circular_spatial_shift(input_tensor, h_shift, w_shift, should_undo=True)
+        input_tensor = utils.random_circular_spatial_shift(input_tensor, h_offset, w_offset, should_undo=True)
 
-        img = utils.pytorch_output_adapter(input_tensor)
-
-    return utils.post_process_numpy_image(img)
+    # The image never left the device while dreaming, post-process it there too and copy it to the CPU only once
+    img = utils.post_process_tensor_img(input_tensor.detach())
+    return utils.pytorch_output_adapter(img)
 
 
 # Feed the output dreamed image back to the input and repeat
 def deep_dream_video_ouroboros(config):
     img_path = os.path.join(config['inputs_path'], config['input'])
-    # load numpy, [0, 1], channel-last, RGB image, None will cause it to start from the uniform noise [0, 1] image
-    frame = None if config['use_noise'] else utils.load_image(img_path, target_shape=config['img_width'])
+    # load numpy, uint8, channel-last, RGB image, None will cause it to start from the uniform noise [0, 1] image
+    frame = None if config['use_noise'] else utils.load_image(img_path, target_shape=config['img_width'], keep_uint8=True)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        saves = []
+        for frame_id in range(config['video_length']):
+            print(f'Dream iteration {frame_id+1}.')
+            frame = deep_dream_static_image(config, frame)
+            saves.append(utils.save_and_maybe_display_image_async(executor, config, frame, should_display=config['should_display'], name_modifier=frame_id))
+            frame = utils.transform_frame(config, frame)  # transform frame e.g. central zoom, spiral, etc.
 
-    for frame_id in range(config['video_length']):
-        print(f'Dream iteration {frame_id+1}.')
-        frame = deep_dream_static_image(config, frame)
-        utils.save_and_maybe_display_image(config, frame, should_display=config['should_display'], name_modifier=frame_id)
-        frame = utils.transform_frame(config, frame)  # transform frame e.g. central zoom, spiral, etc.
+        for save in filter(None, saves):
+            save.result()  # wait for all of the frames to be saved and re-raise any errors
 
     video_utils.create_video_from_intermediate_results(config)
 
@@ -119,17 +132,24 @@ def deep_dream_video(config):
     metadata = video_utils.dump_frames(video_path, tmp_input_dir)
 
     last_img = None
-    for frame_id, frame_name in enumerate(os.listdir(tmp_input_dir)):
-        print(f'Processing frame {frame_id}')
-        frame_path = os.path.join(tmp_input_dir, frame_name)
-        frame = utils.load_image(frame_path, target_shape=config['img_width'])
-        if config['blend'] is not None and last_img is not None:
-            # 1.0 - get only the current frame, 0.5 - combine with last dreamed frame and stabilize the video
-            frame = utils.linear_blend(last_img, frame, config['blend'])
-
-        dreamed_frame = deep_dream_static_image(config, frame)
-        last_img = dreamed_frame
-        utils.save_and_maybe_display_image(config, dreamed_frame, should_display=config['should_display'], name_modifier=frame_id)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        saves = []
+        for frame_id, frame_name in enumerate(os.listdir(tmp_input_dir)):
+            print(f'Processing frame {frame_id}')
+            frame_path = os.path.join(tmp_input_dir, frame_name)
+            should_blend = config['blend'] is not None and last_img is not None
+            # blending needs [0, 1] float frames otherwise keep uint8 and let pytorch_input_adapter normalize it directly
+            frame = utils.load_image(frame_path, target_shape=config['img_width'], keep_uint8=not should_blend)
+            if should_blend:
+                # 1.0 - get only the current frame, 0.5 - combine with last dreamed frame and stabilize the video
+                frame = utils.linear_blend(last_img, frame, config['blend'])
+
+            dreamed_frame = deep_dream_static_image(config, frame)
+            last_img = dreamed_frame  # safe to share with the save thread - nobody modifies dreamed frames in-place
+            saves.append(utils.save_and_maybe_display_image_async(executor, config, dreamed_frame, should_display=config['should_display'], name_modifier=frame_id))
+
+        for save in filter(None, saves):
+            save.result()  # wait for all of the frames to be saved and re-raise any errors
 
     video_utils.create_video_from_intermediate_results(config, metadata)
 
@@ -179,6 +199,8 @@ if __name__ == "__main__":
     parser.add_argument("--spatial_shift_size", type=int, help='Number of pixels to randomly shift image before grad ascent', default=32)
     parser.add_argument("--smoothing_coefficient", type=float, help='Directly controls standard deviation for gradient smoothing', default=0.5)
     parser.add_argument("--use_noise", type=bool, help="Use noise as a starting point instead of input image", default=False)
+    parser.add_argument("--use_bf16", type=bool, help="Run the model in bfloat16 autocast (needs PyTorch 1.10+)", default=False)
+    parser.add_argument("--use_compile", type=bool, help="Compile the model with torch.compile (needs PyTorch 2.0+)", default=False)
     args = parser.parse_args()
 
     # Wrapping configuration into a dictionary - keeping things clean
@@ -2,15 +2,14 @@ import enum
 
 
 import numpy as np
-import torch
 
 
 IMAGENET_MEAN_1 = np.array([0.485, 0.456, 0.406], dtype=np.float32)
 IMAGENET_STD_1 = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# uint8 value -> normalized float32 value lookup table (256x3, one column per channel)
+IMAGENET_UINT8_LUT = ((np.arange(256, dtype=np.float32)[:, np.newaxis] / 255.0 - IMAGENET_MEAN_1) / IMAGENET_STD_1).astype(np.float32)
 
 
-LOWER_IMAGE_BOUND = torch.tensor((-IMAGENET_MEAN_1 / IMAGENET_STD_1).reshape(1, -1, 1, 1)).to('cuda')
-UPPER_IMAGE_BOUND = torch.tensor(((1 - IMAGENET_MEAN_1) / IMAGENET_STD_1).reshape(1, -1, 1, 1)).to('cuda')
 KERNEL_SIZE = 9  # "magic number" picked this one as it just works well
 
 
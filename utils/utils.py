@@ -1,14 +1,13 @@
 import os
-import math
 import numbers
+import functools
+import contextlib
 
 import cv2 as cv
-from torchvision import transforms
 import matplotlib.pyplot as plt
 import torch
 import torch.nn.functional as F
 from torch import nn
-import scipy.ndimage as nd
 
 
 from models.definitions.vggs import Vgg16, Vgg16Experimental
@@ -22,7 +21,7 @@ from .constants import *
 # Image manipulation util functions
 #
 
-def load_image(img_path, target_shape=None):
+def load_image(img_path, target_shape=None, keep_uint8=False):
     if not os.path.exists(img_path):
         raise Exception(f'Path does not exist: {img_path}')
     img = cv.imread(img_path)[:, :, ::-1]  # [:, :, ::-1] converts BGR (opencv format...) into RGB
@@ -36,35 +35,71 @@ def load_image(img_path, target_shape=None):
         else:  # set both dimensions to target shape
             img = cv.resize(img, (target_shape[1], target_shape[0]), interpolation=cv.INTER_CUBIC)
 
+    if keep_uint8:  # pytorch_input_adapter knows how to normalize uint8 images directly
+        return np.ascontiguousarray(img)
+
     # this need to go after resizing - otherwise cv.resize will push values outside of [0,1] range
     img = img.astype(np.float32)  # convert from uint8 to float32
     img /= 255.0  # get to [0, 1] range
     return img
 
 
-def preprocess_numpy_img(img):
-    assert isinstance(img, np.ndarray), f'Expected numpy image got {type(img)}'
+@functools.lru_cache()
+def get_imagenet_mean_std(device):
+    mean = torch.tensor(IMAGENET_MEAN_1.reshape(1, -1, 1, 1), device=device)
+    std = torch.tensor(IMAGENET_STD_1.reshape(1, -1, 1, 1), device=device)
+    return mean, std
 
-    img = (img - IMAGENET_MEAN_1) / IMAGENET_STD_1  # normalize image
-    return img
+
+# Bounds of the normalized image i.e. where [0, 1] range ends up after the normalization
+@functools.lru_cache()
+def get_image_bounds(device, dtype=torch.float32):
+    lower_bound = torch.tensor((-IMAGENET_MEAN_1 / IMAGENET_STD_1).reshape(1, -1, 1, 1), device=device, dtype=dtype)
+    upper_bound = torch.tensor(((1 - IMAGENET_MEAN_1) / IMAGENET_STD_1).reshape(1, -1, 1, 1), device=device, dtype=dtype)
+    return lower_bound, upper_bound
+
+
+def normalize_uint8_lut(img, lut=IMAGENET_UINT8_LUT):
+    assert img.dtype == np.uint8, f'Expected uint8 image got {img.dtype}'
+
+    # A single gather replaces the uint8 -> float32 -> /255 -> -mean -> /std chain
+    return lut[img, np.arange(img.shape[-1])]
 
 
-def post_process_numpy_image(dump_img):
-    assert isinstance(dump_img, np.ndarray), f'Expected numpy image got {type(dump_img)}'
+def preprocess_tensor_img(tensor):
+    # Normalization is done in-place (no temporaries) so make sure you own the passed tensor
+    mean, std = get_imagenet_mean_std(tensor.device)
+    if tensor.dtype == torch.uint8:
+        tensor = tensor.float().div_(255.0)  # get to [0, 1] range
+    return tensor.sub_(mean).div_(std)  # normalize image
 
-    if dump_img.shape[0] == 3:  # if channel-first format move to channel-last (CHW -> HWC)
-        dump_img = np.moveaxis(dump_img, 0, 2)
 
-    mean = IMAGENET_MEAN_1.reshape(1, 1, -1)
-    std = IMAGENET_STD_1.reshape(1, 1, -1)
-    dump_img = (dump_img * std) + mean  # de-normalize
-    dump_img = np.clip(dump_img, 0., 1.)
+def post_process_tensor_img(tensor):
+    # Same as preprocess_tensor_img - done in-place on the device so that only the final image gets copied to the CPU
+    mean, std = get_imagenet_mean_std(tensor.device)
+    return tensor.mul_(std).add_(mean).clamp_(0., 1.)  # de-normalize
 
-    return dump_img
+
+# Reused across calls - safe as pytorch_output_adapter's (blocking) copy syncs with the previous async copy from it
+@functools.lru_cache()
+def get_pinned_buffer(shape, dtype):
+    return torch.empty(shape, dtype=dtype, pin_memory=True)
 
 
 def pytorch_input_adapter(img, device):
-    tensor = transforms.ToTensor()(img).to(device).unsqueeze(0)
+    assert isinstance(img, np.ndarray), f'Expected numpy image got {type(img)}'
+
+    if img.dtype == np.uint8 and device.type == 'cpu':  # LUT already gives us the normalized image
+        tensor = torch.from_numpy(normalize_uint8_lut(img)).permute(2, 0, 1).unsqueeze(0)  # HWC -> 1CHW
+    else:
+        tensor = torch.from_numpy(img)
+        # uint8 goes to the GPU as is (4x less data) and gets converted there
+        dtype = torch.uint8 if tensor.dtype == torch.uint8 else torch.float32
+        if device.type == 'cuda':  # staging through a pinned buffer makes the host to device copy asynchronous
+            tensor = get_pinned_buffer(img.shape, dtype).copy_(tensor).to(device, non_blocking=True)
+        else:  # copy=True because from_numpy shares memory with img and we normalize in-place
+            tensor = tensor.to(device, dtype=dtype, copy=True)
+        tensor = preprocess_tensor_img(tensor.permute(2, 0, 1).unsqueeze(0))  # HWC -> 1CHW
     tensor.requires_grad = True
     return tensor
 
@@ -106,6 +141,14 @@ def save_and_maybe_display_image(config, dump_img, should_display=True, name_mod
         plt.show()
 
 
+# JPEG encoding and disk I/O are done in the background so that they overlap with dreaming of the next frame
+def save_and_maybe_display_image_async(executor, config, dump_img, should_display=True, name_modifier=None):
+    if should_display:  # matplotlib is not thread-safe so fall back to doing everything on the calling thread
+        save_and_maybe_display_image(config, dump_img, should_display=True, name_modifier=name_modifier)
+        return None
+    return executor.submit(save_and_maybe_display_image, config, dump_img, should_display=False, name_modifier=name_modifier)
+
+
 def linear_blend(img1, img2, alpha=0.5):
     return img1 + alpha * (img2 - img1)
 
@@ -115,7 +158,9 @@ def linear_blend(img1, img2, alpha=0.5):
 #
 
 
-def fetch_and_prepare_model(model_type, pretrained_weights, device):
+# Cached so that video frames reuse the same model (and don't trigger a recompilation on every frame)
+@functools.lru_cache()
+def fetch_and_prepare_model(model_type, pretrained_weights, device, should_compile=False):
     if model_type == SupportedModels.VGG16:
         model = Vgg16(pretrained_weights, requires_grad=False, show_progress=True).to(device)
     elif model_type == SupportedModels.VGG16_EXPERIMENTAL:
@@ -128,9 +173,25 @@ def fetch_and_prepare_model(model_type, pretrained_weights, device):
         model = AlexNet(pretrained_weights, requires_grad=False, show_progress=True).to(device)
     else:
         raise Exception('Model not yet supported.')
+
+    model = model.to(memory_format=get_memory_format(device))  # should match the input, see random_circular_spatial_shift
+
+    if should_compile:  # removes per-op Python dispatch overhead from the forward/backward passes (PyTorch 2.0+)
+        if not hasattr(torch, 'compile'):
+            raise Exception(f'torch.compile is not available in PyTorch {torch.__version__}.')
+        model = torch.compile(model)
     return model
 
 
+def bf16_autocast(device, enabled=True):
+    # Unlike float16, bfloat16 has the same range as float32 so no gradient scaling is needed
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise Exception(f'torch.autocast is not available in PyTorch {torch.__version__}.')
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
 # Didn't want to expose these to the outer API - too much clutter, feel free to tweak params here
 def transform_frame(config, frame):
     h, w = frame.shape[:2]
@@ -174,70 +235,90 @@ def random_circular_spatial_shift(tensor, h_shift, w_shift, should_undo=False):
         w_shift = -w_shift
     with torch.no_grad():
         rolled = torch.roll(tensor, shifts=(h_shift, w_shift), dims=(2, 3))
+        # Rolled tensor is what the model gets and roll always outputs NCHW, cuDNN convolutions are faster in NHWC
+        # (it matches the Tensor Core tile layout and avoids internal transposes) so convert it here - no-op on CPU
+        rolled = rolled.contiguous(memory_format=get_memory_format(tensor.device))
         rolled.requires_grad = True
         return rolled
 
 
+def get_memory_format(device):
+    return torch.channels_last if device.type == 'cuda' else torch.contiguous_format
+
+
+def resize_tensor(tensor, new_shape):
+    with torch.no_grad():
+        # bilinear with align_corners=False matches cv.resize's default INTER_LINEAR
+        resized = F.interpolate(tensor, size=(int(new_shape[0]), int(new_shape[1])), mode='bilinear', align_corners=False)
+        resized.requires_grad = True
+        return resized
+
+
 class CascadeGaussianSmoothing(nn.Module):
     """
     Apply gaussian smoothing seperately for each channel (depthwise convolution)
     Arguments:
         kernel_size (int, sequence): Size of the gaussian kernel.
         sigma (float, sequence): Standard deviation of the gaussian kernel.
+        device (torch.device): Device on which the kernels are created.
     """
-    def __init__(self, kernel_size, sigma):
+    def __init__(self, kernel_size, sigma, device):
         super().__init__()
 
         cascade_coefficients = [0.5, 1.0, 2.0]  # std multipliers
 
         sigmas = [[coeff * sigma, coeff * sigma] for coeff in cascade_coefficients]  # isotropic Gaussian
 
-        self.pad = int(kernel_size / 2)  # Used to pad the channels so that after applying the kernel we have same size
-
         if isinstance(kernel_size, numbers.Number):
             kernel_size = [kernel_size, kernel_size]
 
-        meshgrids = torch.meshgrid([torch.arange(size, dtype=torch.float32) for size in kernel_size])
+        # Used to pad the channels so that after applying the kernel we have same size (left, right, top, bottom)
+        self.pad = (kernel_size[1] // 2, kernel_size[1] // 2, kernel_size[0] // 2, kernel_size[0] // 2)
 
-        # The gaussian kernel is the product of the gaussian function of each dimension.
-        kernels = []
+        # The gaussian kernel is the product of the gaussian function of each dimension (i.e. it's separable),
+        # so instead of a single KxK kernel we keep a vertical Kx1 and a horizontal 1xK kernel per sigma (2K vs K^2 MACs)
+        kernels_v, kernels_h = [], []
         for sigma in sigmas:
-            kernel = 1
-            for size_1d, std_1d, mgrid in zip(kernel_size, sigma, meshgrids):
+            kernels_1d = []
+            for size_1d, std_1d in zip(kernel_size, sigma):
                 mean = (size_1d - 1) / 2
-                kernel *= 1 / (std_1d * math.sqrt(2 * math.pi)) * torch.exp(-((mgrid - mean) / std_1d) ** 2 / 2)
-            kernels.append(kernel)
-
-        prepared_kernels = []
-        for kernel in kernels:
-            # Make sure sum of values in gaussian kernel equals 1.
-            kernel = kernel / torch.sum(kernel)
-
-            # Reshape to depthwise convolutional weight
-            kernel = kernel.view(1, 1, *kernel.shape)
-            kernel = kernel.repeat(3, *[1] * (kernel.dim() - 1))
-            kernel = kernel.to('cuda')
-            prepared_kernels.append(kernel)
-
-        self.register_buffer('weight1', prepared_kernels[0])
-        self.register_buffer('weight2', prepared_kernels[1])
-        self.register_buffer('weight3', prepared_kernels[2])
+                grid = torch.arange(size_1d, dtype=torch.float32, device=device)
+                kernel = torch.exp(-((grid - mean) / std_1d) ** 2 / 2)
+                # Make sure sum of values in gaussian kernel equals 1 (the outer product of the two will then sum to 1 too)
+                kernel = kernel / torch.sum(kernel)
+                kernels_1d.append(kernel)
+            kernels_v.append(kernels_1d[0])
+            kernels_h.append(kernels_1d[1])
+
+        # Reshape to depthwise convolutional weights, the whole cascade is applied by a single pair of convolutions:
+        # horizontal one maps each channel c into len(sigmas) channels (c * len(sigmas) + i is smoothed with i-th sigma)
+        # and the vertical one maps those back into channel c - summing the cascade up as part of the convolution
+        num_cascades = len(sigmas)
+        weight_h = torch.stack(kernels_h).repeat(3, 1).view(3 * num_cascades, 1, 1, kernel_size[1])
+        weight_v = torch.stack(kernels_v).view(1, num_cascades, kernel_size[0], 1).repeat(3, 1, 1, 1)
+        self.register_buffer('weight_h', weight_h)
+        self.register_buffer('weight_v', weight_v)
+
         self.conv = F.conv2d
 
     def forward(self, input):
         """
         Apply gaussian filter to input.
         """
-        input = F.pad(input, [self.pad, self.pad, self.pad, self.pad], mode='reflect')
-        grad1 = self.conv(input, weight=self.weight1, groups=3)
-        grad2 = self.conv(input, weight=self.weight2, groups=3)
-        grad3 = self.conv(input, weight=self.weight3, groups=3)
-        return grad1 + grad2 + grad3
+        input = F.pad(input, self.pad, mode='reflect')
+        grad = self.conv(input, weight=self.weight_h, groups=3)  # 3 -> 3 * num_cascades channels
+        return self.conv(grad, weight=self.weight_v, groups=3)  # 3 * num_cascades -> 3 channels (sums the cascade)
+
+
+# Cached as video frames keep asking for the same kernels
+@functools.lru_cache()
+def get_cascade_gaussian_smoothing(kernel_size, sigma, device):
+    return CascadeGaussianSmoothing(kernel_size, sigma, device)
 
 
 # Not used atm.
-def create_image_pyramid(img, num_octaves, octave_scale):
-    img_pyramid = [img]
+def create_image_pyramid(img_tensor, num_octaves, octave_scale):
+    img_pyramid = [img_tensor]
     for i in range(num_octaves-1):  # img_pyramid will have "num_octaves" images
-        img_pyramid.append(cv.resize(img_pyramid[-1], (0, 0), fx=1./octave_scale, fy=1./octave_scale))
+        img_pyramid.append(F.interpolate(img_pyramid[-1], scale_factor=1./octave_scale, mode='bilinear', align_corners=False))
     return img_pyramid